@@ -17,23 +17,32 @@ The Model Card Toolkit (MCT) provides a set of utilities to generate Model Cards
 from trained models, evaluations, and datasets in ML pipelines.
 """
 
+import collections
+import concurrent.futures
 import dataclasses
+import functools
+import hashlib
+import itertools
 import logging
+import mmap
 import os
+import pathlib
 import pkgutil
 import tempfile
-from typing import List, Optional, Text, Union
+from typing import (Any, Callable, Dict, Iterable, Iterator, Optional, Text,
+                    Tuple, TYPE_CHECKING, Union)
 
 from absl import logging
+from google.protobuf.internal import api_implementation
 import jinja2
 
 from model_card_toolkit.model_card import ModelCard
 from model_card_toolkit.proto import model_card_pb2
-from model_card_toolkit.utils import graphics
-from model_card_toolkit.utils import tfx_util
-import tensorflow_model_analysis as tfma
 
-import ml_metadata as mlmd
+# TensorFlow Model Analysis and ML Metadata pull in TensorFlow, so they are only
+# imported when a model card is scaffolded from them.
+if TYPE_CHECKING:
+  import ml_metadata as mlmd
 
 # Constants about provided UI templates.
 _UI_TEMPLATES = (
@@ -42,20 +51,135 @@ _UI_TEMPLATES = (
 )
 _DEFAULT_UI_TEMPLATE_FILE = os.path.join('html', 'default_template.html.jinja')
 
+# HTML for one graphic, see `_graphics_html`.
+_GRAPHIC_HTML = ('<div class="img-item">'
+                 "<img src='data:image/jpeg;base64,{image}' alt='{name}' />"
+                 '</div>')
+
 # Constants about Model Cards Toolkit Assets (MCTA).
 _MCTA_PROTO_FILE = os.path.join('data', 'model_card.proto')
 _MCTA_TEMPLATE_DIR = 'template'
 _MCTA_RESOURCE_DIR = os.path.join('resources', 'plots')
+_MCTA_JINJA_CACHE_DIR = '.jinja_cache'
 
 # Constants about the final generated model cards.
 _MODEL_CARDS_DIR = 'model_cards'
 _DEFAULT_MODEL_CARD_FILE_NAME = 'model_card.html'
 
+# Maximum number of eval results and dataset statistics being loaded, or loaded
+# but not yet annotated, at any one time. This bounds both the I/O concurrency
+# and the number of loaded results held in memory.
+_MAX_CONCURRENT_LOADS = 4
+
+# Reading and writing model card protos is much slower with the pure-Python
+# protobuf implementation than with the native (upb or C++) ones.
+if api_implementation.Type() == 'python':
+  logging.warning(
+      'The pure-Python protobuf implementation is in use, which makes reading '
+      'and writing model cards slow. Install a protobuf package with native '
+      'extensions for better performance.')
+
+
+def _load_in_order(executor: concurrent.futures.Executor,
+                   loads: Iterable[Callable[[], Any]],
+                   max_in_flight: int) -> Iterator[Any]:
+  """Runs loads on the executor and yields their results in order.
+
+  At most `max_in_flight` loads are submitted ahead of the consumer, so only a
+  bounded number of loaded results are held at once. A result is released by
+  this generator as soon as the consumer asks for the next one.
+
+  Args:
+    executor: The executor to run the loads on.
+    loads: Callables without arguments, each loading one result.
+    max_in_flight: The maximum number of loads submitted but not yet consumed.
+
+  Yields:
+    The result of each load, in the order of `loads`.
+  """
+  loads = iter(loads)
+  pending = collections.deque(
+      executor.submit(load) for load in itertools.islice(loads, max_in_flight))
+  while pending:
+    result = pending.popleft().result()
+    for load in itertools.islice(loads, 1):
+      pending.append(executor.submit(load))
+    yield result
+    # Release the result before waiting on the next load.
+    del result
+
+
+@functools.lru_cache(maxsize=None)
+def _load_template_bytes(template_path: Text) -> bytes:
+  """Loads a UI template from the package, caching it for this process.
+
+  Args:
+    template_path: The template path, relative to the model_card_toolkit
+      package.
+
+  Returns:
+    The template file content.
+
+  Raises:
+    FileNotFoundError: If the template is not part of the package.
+  """
+  template_content = pkgutil.get_data('model_card_toolkit', template_path)
+  if template_content is None:
+    raise FileNotFoundError(f"Cannot find file: '{template_path}'")
+  return template_content
+
+
+def _content_hash(data: bytes) -> bytes:
+  """Returns a short digest identifying the content of data."""
+  return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _stat_signature(path: Text) -> Optional[Tuple[int, int]]:
+  """Returns the modification time and size of path, or None if missing."""
+  try:
+    stat = os.stat(path)
+  except FileNotFoundError:
+    return None
+  return stat.st_mtime_ns, stat.st_size
+
+
+def _graphics_html(graphics: Any) -> jinja2.Markup:
+  """Renders a list of graphics as HTML.
+
+  This is registered as the `graphics_html` template filter. Graphic lists can
+  hold many large base64 images, so they are joined into a single string here
+  rather than looped over in the template.
 
-@dataclasses.dataclass
+  Args:
+    graphics: A list of objects with `name` and `image` attributes.
+
+  Returns:
+    The (escaped) HTML for all graphics.
+  """
+  return jinja2.Markup(''.join(
+      _GRAPHIC_HTML.format(
+          image=jinja2.escape(graphic.image or ''),
+          name=jinja2.escape(graphic.name or ''))
+      for graphic in graphics))
+
+
+def _none_as_empty(value: Any) -> Any:
+  """Renders unset (None) model card fields as empty strings.
+
+  This is the `finalize` function of the Jinja environments. Unset fields of
+  model card protos already render as empty strings, so ModelCard objects
+  render the same way as their protos.
+  """
+  return '' if value is None else value
+
+
+@dataclasses.dataclass(frozen=True)
 class Source:
   """Sources to extract data for a model card.
 
+  Source is immutable. The path sequences are stored as tuples; to use
+  different paths, create a new Source.
+
   Attributes:
     eval_result_paths: The paths to the output from TensorFlow Model Analysis or
       TFX Evaluator.
@@ -64,9 +188,17 @@ class Source:
     dataset_statistics_paths: The paths to the output from TensorFlow Data
       Validation or TFX ExampleValidator.
   """
-  eval_result_paths: List[Text] = dataclasses.field(default_factory=list)
+  eval_result_paths: Tuple[Text, ...] = ()
   eval_result_file_format: Optional[Text] = ''
-  dataset_statistics_paths: List[Text] = dataclasses.field(default_factory=list)
+  dataset_statistics_paths: Tuple[Text, ...] = ()
+
+  def __post_init__(self):
+    # Accept any sequence of paths, e.g. lists, or None for no paths, but store
+    # them as tuples.
+    object.__setattr__(self, 'eval_result_paths',
+                       tuple(self.eval_result_paths or ()))
+    object.__setattr__(self, 'dataset_statistics_paths',
+                       tuple(self.dataset_statistics_paths or ()))
 
 
 class ModelCardToolkit():
@@ -111,14 +243,14 @@ class ModelCardToolkit():
   # TODO(b/188707257): combine mlmd_store and model_uri args
   def __init__(self,
                output_dir: Optional[Text] = None,
-               mlmd_store: Optional[mlmd.MetadataStore] = None,
+               mlmd_store: Optional['mlmd.MetadataStore'] = None,
                model_uri: Optional[Text] = None,
                source: Optional[Source] = None):
     """Initializes the ModelCardToolkit.
 
-    This function does not generate any assets by itself. Use the other API
-    functions to generate Model Card assets. See class-level documentation for
-    example usage.
+    This function does not generate any assets by itself, it only creates the
+    (empty) asset directories. Use the other API functions to generate Model
+    Card assets. See class-level documentation for example usage.
 
     Args:
       output_dir: The path where MCT assets (such as data files and model cards)
@@ -137,11 +269,12 @@ class ModelCardToolkit():
       ValueError: If `mlmd_store` is given and the `model_uri` cannot be
         resolved as a model artifact in the metadata store.
     """
-    self.output_dir = output_dir or tempfile.mkdtemp()
-    self._mcta_proto_file = os.path.join(self.output_dir, _MCTA_PROTO_FILE)
-    self._mcta_template_dir = os.path.join(self.output_dir, _MCTA_TEMPLATE_DIR)
-    self._model_cards_dir = os.path.join(self.output_dir, _MODEL_CARDS_DIR)
     self._source = source
+    self._jinja_envs: Dict[Text, jinja2.Environment] = {}
+    # Maps proto file paths to the content hash and stat signature of the
+    # content last written to or read from them.
+    self._serialized_cache: Dict[Text, Tuple[bytes,
+                                             Optional[Tuple[int, int]]]] = {}
 
     # if mlmd_store and model_uri are both set, use them
     self._store = mlmd_store
@@ -159,32 +292,100 @@ class ModelCardToolkit():
     elif model_uri and not mlmd_store:
       logging.info('`model_uri` ignored when `mlmd_store` is not set.')
 
+    # Only touch the file system once the arguments are known to be valid.
+    self.output_dir = output_dir or tempfile.mkdtemp()
+    self._mcta_proto_file = os.path.join(self.output_dir, _MCTA_PROTO_FILE)
+    self._mcta_template_dir = os.path.join(self.output_dir, _MCTA_TEMPLATE_DIR)
+    self._model_cards_dir = os.path.join(self.output_dir, _MODEL_CARDS_DIR)
+    self._default_template_path = os.path.join(self._mcta_template_dir,
+                                               _DEFAULT_UI_TEMPLATE_FILE)
+    for asset_dir in (os.path.dirname(self._mcta_proto_file),
+                      self._mcta_template_dir, self._model_cards_dir):
+      os.makedirs(asset_dir, exist_ok=True)
+
   def _jinja_loader(self, template_dir: Text):
     return jinja2.FileSystemLoader(template_dir)
 
+  def _get_env(self, template_dir: Text) -> jinja2.Environment:
+    """Returns the cached Jinja environment for the template directory.
+
+    Compiled templates are kept in the environment's cache, so each template is
+    only compiled once. `auto_reload` stays enabled, so templates which are
+    edited on disk are still picked up. The compiled bytecode is also persisted
+    under `output_dir`, so later processes reusing the same assets skip
+    compilation as well.
+    """
+    env = self._jinja_envs.get(template_dir)
+    if env is None:
+      bytecode_cache_dir = os.path.join(self.output_dir, _MCTA_JINJA_CACHE_DIR)
+      os.makedirs(bytecode_cache_dir, exist_ok=True)
+      env = jinja2.Environment(
+          loader=self._jinja_loader(template_dir),
+          autoescape=True,
+          auto_reload=True,
+          finalize=_none_as_empty,
+          bytecode_cache=jinja2.FileSystemBytecodeCache(
+              directory=bytecode_cache_dir))
+      env.filters['graphics_html'] = _graphics_html
+      self._jinja_envs[template_dir] = env
+    return env
+
   def _write_file(self, path: Text, content: Text) -> None:
     """Write content to the path."""
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, 'w+') as f:
-      f.write(content)
-
-  def _write_proto_file(
-      self, path: Text, model_card: Union[ModelCard,
-                                          model_card_pb2.ModelCard]) -> None:
-    """Write serialized model card proto to the path."""
-    os.makedirs(os.path.dirname(path), exist_ok=True)
-    with open(path, 'wb') as f:
-      if isinstance(model_card, ModelCard):
-        f.write(model_card.to_proto().SerializeToString())
-      else:
-        f.write(model_card.SerializeToString())
+    pathlib.Path(path).write_text(content, encoding='utf-8')
+
+  def _write_bytes(self, path: Text, data: bytes) -> None:
+    """Write binary data to the path."""
+    pathlib.Path(path).write_bytes(data)
 
-  def _read_proto_file(self, path: Text) -> ModelCard:
-    """Read serialized model card proto from the path."""
+  def _write_proto_bytes(self, path: Text, serialized: bytes) -> None:
+    """Write a serialized model card proto to the path.
+
+    The write is skipped if the file already holds the same content, i.e. it
+    was last written or read with this content by this ModelCardToolkit and has
+    not been modified since.
+    """
+    serialized_hash = _content_hash(serialized)
+    cached = self._serialized_cache.get(path)
+    if cached and cached == (serialized_hash, _stat_signature(path)):
+      return
+    pathlib.Path(path).write_bytes(serialized)
+    self._serialized_cache[path] = (serialized_hash, _stat_signature(path))
+
+  def _read_proto_file_as_proto(self, path: Text) -> model_card_pb2.ModelCard:
+    """Read serialized model card proto from the path, as a proto.
+
+    With the C++ protobuf backend, the file is memory-mapped and parsed in
+    place, without copying it into a bytes object first. Other backends copy
+    any buffer into bytes before parsing, so the file is simply read with
+    `read_bytes()` there.
+    """
     model_card_proto = model_card_pb2.ModelCard()
-    with open(path, 'rb') as f:
-      model_card_proto.ParseFromString(f.read())
-    return ModelCard().copy_from_proto(model_card_proto)
+    # mmap cannot map empty files, which hold an empty model card.
+    if api_implementation.Type() != 'cpp' or os.path.getsize(path) == 0:
+      serialized = pathlib.Path(path).read_bytes()
+      self._serialized_cache[path] = (_content_hash(serialized),
+                                      _stat_signature(path))
+      model_card_proto.ParseFromString(serialized)
+      return model_card_proto
+    with open(path, 'rb') as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ) as serialized:
+      self._serialized_cache[path] = (_content_hash(serialized),
+                                      _stat_signature(path))
+      with memoryview(serialized) as view:
+        model_card_proto.ParseFromString(view)
+    return model_card_proto
+
+  def _render(self, template_path: Text,
+              model_card: Union[ModelCard, model_card_pb2.ModelCard]) -> Text:
+    """Renders the model card with the Jinja template at template_path."""
+    template = self._get_env(os.path.dirname(template_path)).get_template(
+        os.path.basename(template_path))
+    return template.render(
+        model_details=model_card.model_details,
+        model_parameters=model_card.model_parameters,
+        quantitative_analysis=model_card.quantitative_analysis,
+        considerations=model_card.considerations)
 
   def _scaffold_model_card(self) -> ModelCard:
     """Generates the ModelCard for scaffold_assets().
@@ -197,6 +398,12 @@ class ModelCardToolkit():
     Returns:
       A ModelCard representing the given model.
     """
+    # pylint: disable=g-import-not-at-top
+    from model_card_toolkit.utils import graphics
+    from model_card_toolkit.utils import tfx_util
+    import tensorflow_model_analysis as tfma
+    # pylint: enable=g-import-not-at-top
+
     # Pre-populate ModelCard fields
     if self._store:
       model_card = tfx_util.generate_model_card_for_model(
@@ -204,42 +411,71 @@ class ModelCardToolkit():
     else:
       model_card = ModelCard()
 
-    # Generate graphics for TFMA's `EvalResult`s
-    if self._source:
-      if self._source.eval_result_paths:
-        for eval_result_path in self._source.eval_result_paths:
-          eval_result = tfma.load_eval_result(
-              output_path=eval_result_path,
-              output_file_format=self._source.eval_result_file_format)
-          if eval_result:
-            logging.info('EvalResult found at path %s', eval_result_path)
-            tfx_util.annotate_eval_result_metrics(model_card, eval_result)
-            graphics.annotate_eval_result_plots(model_card, eval_result)
-          else:
-            logging.info('EvalResult not found at path %s', eval_result_path)
+    # Find the model's metrics and statistics artifacts. The MLMD queries share
+    # the store's connection, so they are made sequentially on this thread.
+    metrics_artifacts = []
+    stats_artifacts = []
     if self._store:
       metrics_artifacts = tfx_util.get_metrics_artifacts_for_model(
           self._store, self._artifact_with_model_uri.id)
-      for metrics_artifact in metrics_artifacts:
-        eval_result = tfx_util.read_metrics_eval_result(metrics_artifact.uri)
-        if eval_result is not None:
-          tfx_util.annotate_eval_result_metrics(model_card, eval_result)
-          graphics.annotate_eval_result_plots(model_card, eval_result)
-
-    # Generate graphics for TFDV's `DatasetFeatureStatisticsList`s
-    if self._source:
-      if self._source.dataset_statistics_paths:
-        for dataset_statistics_path in self._source.dataset_statistics_paths:
-          data_stats = tfx_util.read_stats_protos(dataset_statistics_path)
-          graphics.annotate_dataset_feature_statistics_plots(
-              model_card, data_stats)
-    if self._store:
       stats_artifacts = tfx_util.get_stats_artifacts_for_model(
           self._store, self._artifact_with_model_uri.id)
-      for stats_artifact in stats_artifacts:
-        data_stats = tfx_util.read_stats_protos(stats_artifact.uri)
-        graphics.annotate_dataset_feature_statistics_plots(
-            model_card, data_stats)
+
+    eval_result_paths = []
+    dataset_statistics_paths = []
+    if self._source:
+      eval_result_paths = self._source.eval_result_paths
+      dataset_statistics_paths = self._source.dataset_statistics_paths
+
+    def annotate_eval_result(eval_result_path, eval_result):
+      if eval_result:
+        logging.info('EvalResult found at path %s', eval_result_path)
+        tfx_util.annotate_eval_result_metrics(model_card, eval_result)
+        graphics.annotate_eval_result_plots(model_card, eval_result)
+      else:
+        logging.info('EvalResult not found at path %s', eval_result_path)
+
+    def annotate_metrics_artifact(eval_result):
+      if eval_result is not None:
+        tfx_util.annotate_eval_result_metrics(model_card, eval_result)
+        graphics.annotate_eval_result_plots(model_card, eval_result)
+
+    def annotate_data_stats(data_stats):
+      graphics.annotate_dataset_feature_statistics_plots(model_card, data_stats)
+
+    # Each entry pairs a load of an `EvalResult` or
+    # `DatasetFeatureStatisticsList` with the function annotating it.
+    loads = []
+    for eval_result_path in eval_result_paths:
+      loads.append((functools.partial(
+          tfma.load_eval_result,
+          output_path=eval_result_path,
+          output_file_format=self._source.eval_result_file_format),
+                    functools.partial(annotate_eval_result, eval_result_path)))
+    for metrics_artifact in metrics_artifacts:
+      loads.append((functools.partial(tfx_util.read_metrics_eval_result,
+                                      metrics_artifact.uri),
+                    annotate_metrics_artifact))
+    for dataset_statistics_path in itertools.chain(
+        dataset_statistics_paths,
+        (stats_artifact.uri for stats_artifact in stats_artifacts)):
+      loads.append((functools.partial(tfx_util.read_stats_protos,
+                                      dataset_statistics_path),
+                    annotate_data_stats))
+    if not loads:
+      return model_card
+
+    # Load the results concurrently, a bounded number at a time. The results
+    # are annotated on this thread, in the order above, so the generated model
+    # card is deterministic.
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(_MAX_CONCURRENT_LOADS, len(loads))) as executor:
+      results = _load_in_order(executor, (load for load, _ in loads),
+                               _MAX_CONCURRENT_LOADS)
+      for (_, annotate), result in zip(loads, results):
+        annotate(result)
+        # Release the result once annotated, before the next one is loaded.
+        del result
 
     return model_card
 
@@ -267,16 +503,31 @@ class ModelCardToolkit():
     model_card = self._scaffold_model_card()
 
     # Write Proto file.
-    self._write_proto_file(self._mcta_proto_file, model_card)
-
-    # Write UI template files.
+    self._write_proto_bytes(self._mcta_proto_file,
+                            model_card.to_proto().SerializeToString())
+
+    # Write UI template files. All templates are read first, then written
+    # concurrently.
+    output_paths = []
+    template_contents = []
+    template_dirs = set()
     for template_path in _UI_TEMPLATES:
-      template_content = pkgutil.get_data('model_card_toolkit', template_path)
-      if template_content is None:
-        raise FileNotFoundError(f"Cannot find file: '{template_path}'")
-      template_content = template_content.decode('utf8')
-      self._write_file(
-          os.path.join(self.output_dir, template_path), template_content)
+      template_content = _load_template_bytes(template_path)
+      output_path = os.path.join(self.output_dir, template_path)
+      template_dir = os.path.dirname(output_path)
+      if template_dir not in template_dirs:
+        os.makedirs(template_dir, exist_ok=True)
+        template_dirs.add(template_dir)
+      output_paths.append(output_path)
+      template_contents.append(template_content)
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(output_paths)) as executor:
+      # Consume the results so that write errors are raised here.
+      list(executor.map(self._write_bytes, output_paths, template_contents))
+
+    # Compile the default template now, so export_format() can reuse it.
+    self._get_env(os.path.dirname(self._default_template_path)).get_template(
+        os.path.basename(self._default_template_path))
 
     return model_card
 
@@ -290,7 +541,10 @@ class ModelCardToolkit():
     Raises:
        Error: when the given model_card is invalid w.r.t. the schema.
     """
-    self._write_proto_file(self._mcta_proto_file, model_card)
+    if isinstance(model_card, ModelCard):
+      model_card = model_card.to_proto()
+    self._write_proto_bytes(self._mcta_proto_file,
+                            model_card.SerializeToString())
 
   def export_format(self,
                     model_card: Optional[Union[
@@ -319,41 +573,33 @@ class ModelCardToolkit():
       MCTError: If `export_format` is called before `scaffold_assets` has
         generated model card assets.
     """
-    if not template_path:
-      template_path = os.path.join(self._mcta_template_dir,
-                                   _DEFAULT_UI_TEMPLATE_FILE)
-    template_dir = os.path.dirname(template_path)
-    template_file = os.path.basename(template_path)
+    template_path = template_path or self._default_template_path
 
-    # If model_card is passed in, write to Proto file.
+    # If model_card is passed in, write to Proto file. The write is skipped if
+    # the file already holds this model card.
     if model_card:
       self.update_model_card(model_card)
-    # If model_card is not passed in, read from Proto file.
+      model_card_file_content = self._render(template_path, model_card)
+    # If model_card is not passed in, read from Proto file. The proto is
+    # rendered directly, without converting it to a ModelCard first.
     elif os.path.exists(self._mcta_proto_file):
-      model_card = self._read_proto_file(self._mcta_proto_file)
+      model_card = self._read_proto_file_as_proto(self._mcta_proto_file)
+      model_card_file_content = self._render(template_path, model_card)
     # If model card proto never created, raise exception.
     else:
       raise ValueError(
           'scaffold_assets() must be called before export_format().')
 
-    # Generate Model Card.
-    jinja_env = jinja2.Environment(
-        loader=self._jinja_loader(template_dir),
-        autoescape=True,
-        auto_reload=True,
-        cache_size=0)
-    template = jinja_env.get_template(template_file)
-    model_card_file_content = template.render(
-        model_details=model_card.model_details,
-        model_parameters=model_card.model_parameters,
-        quantitative_analysis=model_card.quantitative_analysis,
-        considerations=model_card.considerations)
-
     # Write the model card document file and return its contents.
     mode_card_file_path = os.path.join(self._model_cards_dir, output_file)
+    if os.path.dirname(output_file):
+      os.makedirs(os.path.dirname(mode_card_file_path), exist_ok=True)
     self._write_file(mode_card_file_path, model_card_file_content)
     return model_card_file_content
 
   def save_mlmd(self) -> None:
-    """Saves the model card of the model artifact with `model_uri` to MLMD."""
-    pass
+    """Saves the model card of the model artifact with `model_uri` to MLMD.
+
+    This is not implemented yet, and currently does nothing.
+    """
+    return None
@@ -13,7 +13,9 @@
 # limitations under the License.
 """Tests for model_card_toolkit."""
 
+import mmap
 import os
+import pathlib
 from typing import List, Text
 from unittest import mock
 import uuid
@@ -143,12 +145,27 @@ class ModelCardToolkitTest(
     with open(eval_stats_file, mode='wb') as f:
       f.write(eval_stats_list.SerializeToString())
 
+  def test_source_is_immutable(self):
+    source = model_card_toolkit.Source(
+        eval_result_paths=['eval_path'], dataset_statistics_paths=['stats'])
+    self.assertEqual(source.eval_result_paths, ('eval_path',))
+    self.assertEqual(source.dataset_statistics_paths, ('stats',))
+    with self.assertRaises(AttributeError):
+      source.eval_result_paths = ('other_eval_path',)
+
+  def test_source_with_none_paths(self):
+    source = model_card_toolkit.Source(
+        eval_result_paths=None, dataset_statistics_paths=None)
+    self.assertEqual(source.eval_result_paths, ())
+    self.assertEqual(source.dataset_statistics_paths, ())
+
   def test_init_with_store_no_model_uri(self):
     store = testdata_utils.get_tfx_pipeline_metadata_store(self.tmp_db_path)
     with self.assertRaisesRegex(
         ValueError, 'If `mlmd_store` is set, `model_uri` should be set.'):
       model_card_toolkit.ModelCardToolkit(
           output_dir=self.tmpdir, mlmd_store=store)
+    self.assertEmpty(os.listdir(self.tmpdir))
 
   def test_init_with_store_model_uri_not_found(self):
     store = testdata_utils.get_tfx_pipeline_metadata_store(self.tmp_db_path)
@@ -169,6 +186,7 @@ class ModelCardToolkitTest(
                   os.listdir(os.path.join(output_dir, 'template/md')))
     self.assertIn('model_card.proto',
                   os.listdir(os.path.join(output_dir, 'data')))
+    self.assertNotEmpty(os.listdir(os.path.join(output_dir, '.jinja_cache')))
 
   @mock.patch.object(
       graphics, 'annotate_dataset_feature_statistics_plots', autospec=True)
@@ -276,6 +294,66 @@ class ModelCardToolkitTest(
       model_card_proto.ParseFromString(f.read())
     self.assertEqual(model_card_proto, valid_model_card)
 
+  def test_update_model_card_skips_unchanged_model_card(self):
+    mct = model_card_toolkit.ModelCardToolkit(output_dir=self.tmpdir)
+    mc = mct.scaffold_assets()
+    mc.model_details.name = 'My Model'
+    mct.update_model_card(mc)
+
+    with mock.patch.object(
+        pathlib.Path, 'write_bytes', autospec=True) as mock_write_bytes:
+      mct.update_model_card(mc)
+      mock_write_bytes.assert_not_called()
+
+      mc.model_details.name = 'My Other Model'
+      mct.update_model_card(mc)
+      mock_write_bytes.assert_called_once()
+
+  def test_export_format_memory_maps_proto_file_on_cpp_backend(self):
+    mct = model_card_toolkit.ModelCardToolkit(output_dir=self.tmpdir)
+    mc = mct.scaffold_assets()
+    mc.model_details.name = 'My Model'
+    mct.update_model_card(mc)
+    proto_path = os.path.join(self.tmpdir, 'data/model_card.proto')
+    with open(proto_path, 'rb') as f:
+      serialized = f.read()
+    self.assertNotEmpty(serialized)
+
+    # A new ModelCardToolkit has not seen the proto file yet.
+    mct = model_card_toolkit.ModelCardToolkit(output_dir=self.tmpdir)
+    with mock.patch.object(
+        model_card_toolkit.api_implementation, 'Type', return_value='cpp'):
+      with mock.patch.object(
+          model_card_toolkit.mmap, 'mmap', wraps=mmap.mmap) as mock_mmap:
+        result = mct.export_format()
+        mock_mmap.assert_called_once()
+    self.assertIn('My Model', result)
+    # pylint: disable=protected-access
+    self.assertEqual(mct._serialized_cache[proto_path],
+                     (model_card_toolkit._content_hash(serialized),
+                      model_card_toolkit._stat_signature(proto_path)))
+    # pylint: enable=protected-access
+
+    with mock.patch.object(
+        pathlib.Path, 'write_bytes', autospec=True) as mock_write_bytes:
+      mct.update_model_card(mc)
+      mock_write_bytes.assert_not_called()
+
+  def test_update_model_card_rewrites_modified_proto_file(self):
+    mct = model_card_toolkit.ModelCardToolkit(output_dir=self.tmpdir)
+    mc = mct.scaffold_assets()
+    mc.model_details.name = 'My Model'
+    mct.update_model_card(mc)
+    proto_path = os.path.join(self.tmpdir, 'data/model_card.proto')
+    with open(proto_path, 'wb') as f:
+      f.write(model_card_pb2.ModelCard().SerializeToString())
+
+    mct.update_model_card(mc)
+    model_card_proto = model_card_pb2.ModelCard()
+    with open(proto_path, 'rb') as f:
+      model_card_proto.ParseFromString(f.read())
+    self.assertEqual(model_card_proto, mc.to_proto())
+
   def test_export_format(self):
     store = testdata_utils.get_tfx_pipeline_metadata_store(self.tmp_db_path)
     mct = model_card_toolkit.ModelCardToolkit(
@@ -321,6 +399,102 @@ class ModelCardToolkitTest(
       self.assertTrue(content.startswith('<!DOCTYPE html>'))
       self.assertIn('My Model', content)
 
+  def test_export_format_with_model_card_proto(self):
+    mct = model_card_toolkit.ModelCardToolkit(output_dir=self.tmpdir)
+    mct.scaffold_assets()
+    model_card_proto = model_card_pb2.ModelCard()
+    model_card_proto.model_details.name = 'My Model'
+    model_card_proto.model_details.owners.add(name='Foo', contact='foo@xyz.com')
+    model_card_proto.quantitative_analysis.graphics.collection.add(
+        name='my_graphic', image='abcd')
+
+    result = mct.export_format(model_card=model_card_proto)
+    self.assertIn('My Model', result)
+    self.assertIn('Foo, foo@xyz.com', result)
+    self.assertIn("alt='my_graphic'", result)
+
+  def test_export_format_from_proto_file_matches_model_card(self):
+    mct = model_card_toolkit.ModelCardToolkit(output_dir=self.tmpdir)
+    mc = mct.scaffold_assets()
+    mc.model_details.name = 'My Model'
+    # Entries with unset fields, which must render blank rather than 'None'.
+    mc.model_details.owners = [model_card.Owner(name='Foo')]
+    mc.model_details.references = [model_card.Reference()]
+    mc.model_details.citations = [model_card.Citation()]
+    mc.model_parameters.data = [
+        model_card.Dataset(
+            graphics=model_card.GraphicsCollection(
+                collection=[model_card.Graphic()]))
+    ]
+    mc.quantitative_analysis.performance_metrics = [
+        model_card.PerformanceMetric(
+            confidence_interval=model_card.ConfidenceInterval())
+    ]
+    mc.considerations.users = [model_card.User()]
+    mc.considerations.ethical_considerations = [model_card.Risk()]
+
+    md_template_path = os.path.join(self.tmpdir,
+                                    'template/md/default_template.md.jinja')
+    for template_path in (None, md_template_path):
+      result = mct.export_format(model_card=mc, template_path=template_path)
+      self.assertNotIn('None', result)
+      self.assertEqual(mct.export_format(template_path=template_path), result)
+      self.assertEqual(
+          mct.export_format(
+              model_card=mc.to_proto(), template_path=template_path), result)
+
+  def test_export_format_with_empty_model_card_proto_file(self):
+    mct = model_card_toolkit.ModelCardToolkit(output_dir=self.tmpdir)
+    mct.scaffold_assets()
+    mct.update_model_card(model_card_pb2.ModelCard())
+    proto_path = os.path.join(self.tmpdir, 'data/model_card.proto')
+    self.assertEqual(os.path.getsize(proto_path), 0)
+
+    result = mct.export_format()
+    self.assertTrue(result.startswith('<!DOCTYPE html>'))
+
+  def test_export_format_escapes_html_once(self):
+    mct = model_card_toolkit.ModelCardToolkit(output_dir=self.tmpdir)
+    mc = mct.scaffold_assets()
+    mc.model_details.name = '<b>My & Model</b>'
+
+    result = mct.export_format(model_card=mc)
+    self.assertIn('&lt;b&gt;My &amp; Model&lt;/b&gt;', result)
+    self.assertNotIn('&amp;lt;', result)
+
+  def test_export_format_passes_unescaped_strings_to_template(self):
+    mct = model_card_toolkit.ModelCardToolkit(output_dir=self.tmpdir)
+    mc = mct.scaffold_assets()
+    mc.model_details.name = 'AAAA & BBBB'
+    template_path = os.path.join(self.tmpdir, 'template/my_template.jinja')
+    with open(template_path, 'w') as f:
+      f.write("{{ model_details.name|length }} "
+              "{{ model_details.name == 'AAAA & BBBB' }} "
+              "{{ model_details.name|truncate(9, True, '', 0) }}")
+    self.assertEqual(
+        mct.export_format(model_card=mc, template_path=template_path),
+        '11 True AAAA &amp; BB')
+
+  def test_export_format_reloads_modified_template(self):
+    mct = model_card_toolkit.ModelCardToolkit(output_dir=self.tmpdir)
+    mc = mct.scaffold_assets()
+    mc.model_details.name = 'My Model'
+    template_path = os.path.join(self.tmpdir, 'template/my_template.jinja')
+    with open(template_path, 'w') as f:
+      f.write('Name: {{ model_details.name }}')
+    self.assertEqual(
+        mct.export_format(model_card=mc, template_path=template_path),
+        'Name: My Model')
+
+    with open(template_path, 'w') as f:
+      f.write('Model: {{ model_details.name }}')
+    # Bump the mtime so the change is seen even on coarse-grained filesystems.
+    mtime = os.path.getmtime(template_path) + 10
+    os.utime(template_path, (mtime, mtime))
+    self.assertEqual(
+        mct.export_format(model_card=mc, template_path=template_path),
+        'Model: My Model')
+
   def test_export_format_before_scaffold_assets(self):
     with self.assertRaises(ValueError):
       model_card_toolkit.ModelCardToolkit().export_format()
@@ -326,7 +326,9 @@ def figure_to_base64str(fig: matplotlib.figure.Figure) -> str:
   """
   buf = io.BytesIO()
   fig.savefig(buf, bbox_inches='tight', format='png')
-  return base64.b64encode(buf.getbuffer().tobytes()).decode('ascii')
+  # Encode straight from the buffer, without an intermediate copy of the PNG.
+  with buf.getbuffer() as png:
+    return base64.b64encode(png).decode('ascii')
 
 
 # FeatureValueType represents a value that a feature could take.